@@ -1,12 +1,24 @@
 import os
+import asyncio
 import logging
 import csv
+import hashlib
+import hmac
+import html
+import io
 import random
+import re
+import secrets
+import sys
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+import orjson
 
 # Import per FastAPI
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response
 # Import per Telegram Bot
-from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler
 from telegram.constants import ParseMode
 
@@ -18,125 +30,201 @@ if not TELEGRAM_BOT_TOKEN or not RENDER_EXTERNAL_HOSTNAME:
     raise ValueError("Variabili d'ambiente TELEGRAM_BOT_TOKEN o RENDER_EXTERNAL_HOSTNAME mancanti.")
 
 WEBHOOK_URL_BASE = f"https://{RENDER_EXTERNAL_HOSTNAME}"
+# Opzionale: se impostato, Telegram lo invia in ogni richiesta e il webhook scarta quelle senza
+TELEGRAM_SECRET_TOKEN = os.getenv("TELEGRAM_SECRET_TOKEN")
 WEBHOOK_PATH = "/webhook"
+if TELEGRAM_SECRET_TOKEN:
+    # Un'impronta breve del secret nel percorso: se il secret cambia cambia anche l'URL del webhook,
+    # così setup_webhook se ne accorge confrontandolo con quello registrato su Telegram.
+    # È un HMAC con chiave il token del bot: l'URL finisce nei log di accesso e in getWebhookInfo,
+    # e un hash semplice permetterebbe di ricavare il secret per forza bruta
+    WEBHOOK_PATH += "/" + hmac.new(
+        TELEGRAM_BOT_TOKEN.encode(), TELEGRAM_SECRET_TOKEN.encode(), hashlib.sha256
+    ).hexdigest()[:12]
+WEBHOOK_MAX_CONNECTIONS = 100
+# Il bot gestisce solo comandi e pulsanti inline: gli altri tipi di update non vengono inviati
+WEBHOOK_ALLOWED_UPDATES = ["message", "callback_query"]
 CSV_FILE = "characters.csv" 
-CURRENT_CHAR_KEY = 'current_char'
+CSV_COLUMNS = ["Nome", "Categoria", "Bio"]
+
+# Personaggi letti dal CSV una sola volta all'avvio (vedi lifespan)
+_CHARACTERS = ()
+# Metodo randrange di un generatore dedicato alla scelta del personaggio, risolto una volta sola
+_randrange = random.Random().randrange
+# Personaggio in gioco per ogni utente (id Telegram -> Character), dal /start fino alla risposta
+_CURRENT_CHARACTERS = {}
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- FUNZIONI DI GIOCO E GESTIONE CSV ---
 
+# Categorie valide, identiche alle callback_data della tastiera del quiz
+_CATEGORIES = frozenset(("GENIO", "MASSONE", "ENTRAMBI", "COMUNE"))
+
+@dataclass(slots=True, frozen=True)
+class Character:
+    """Un personaggio del quiz, letto da una riga del CSV."""
+    start_message: str  # messaggio HTML con il nome del personaggio, pronto per il quiz
+    categoria: str  # già normalizzata: GENIO, MASSONE, ENTRAMBI o COMUNE
+    bio_html: str  # spiegazione senza frase iniziale, già convertita in HTML (vedi bio_to_html)
+
 def read_characters():
-    """Legge tutti i personaggi dal file CSV."""
-    characters = []
+    """Legge tutti i personaggi dal file CSV (chiamata una sola volta all'avvio, fallisce se manca)."""
     try:
+        # Il file viene letto in un colpo solo; il parsing avviene poi sul testo in memoria
         with open(CSV_FILE, mode='r', newline='', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                characters.append(row)
+            data = file.read()
     except FileNotFoundError:
-        logger.error(f"File {CSV_FILE} non trovato. Assicurati che esista!")
-        return []
+        # Senza personaggi il bot è inutilizzabile: meglio fermare l'avvio che servire errori
+        logger.error("File %s non trovato. Assicurati che esista!", CSV_FILE)
+        raise
+
+    characters = []
+    reader = csv.reader(io.StringIO(data))
+    # Le colonne vengono lette per posizione: l'intestazione va verificata una volta sola qui
+    header = next(reader, None)
+    if header is None or [column.strip() for column in header[:3]] != CSV_COLUMNS:
+        raise ValueError(f"Intestazione di {CSV_FILE} non valida: attese le colonne {', '.join(CSV_COLUMNS)}.")
+    for row in reader:
+        if len(row) < 3:
+            logger.warning("%s, riga %d: colonne mancanti, personaggio ignorato.", CSV_FILE, reader.line_num)
+            continue
+        nome, categoria, *bio_parts = row
+        # La Bio contiene virgole non racchiuse tra virgolette: ricomponi i campi in eccesso
+        bio = ",".join(bio_parts)
+        categoria = categoria.strip().upper()
+        # Allinea il vecchio "PERSONA COMUNE" a "COMUNE", come nelle callback_data
+        if categoria == "PERSONA COMUNE":
+            categoria = "COMUNE"
+        # Una categoria sconosciuta renderebbe il personaggio impossibile da indovinare
+        if categoria not in _CATEGORIES:
+            logger.warning(
+                "%s, riga %d: categoria '%s' non valida, personaggio ignorato.", CSV_FILE, reader.line_num, categoria
+            )
+            continue
+        # Solo quattro valori possibili: una sola copia in memoria, e == si risolve per identità
+        categoria = sys.intern(categoria)
+        characters.append(Character(
+            start_message=(
+                f"Il personaggio scelto a caso è: <b>{html.escape(nome, quote=False)}</b>\n\n"
+                f"Indovina la sua vera identità:"
+            ),
+            categoria=categoria,
+            bio_html=bio_to_html(get_bio_explanation_cleaned(bio))
+        ))
     return characters
 
-def select_random_character(context):
-    """Seleziona un personaggio casuale dalla lista e lo salva nel contesto utente."""
-    characters = read_characters()
-    if not characters:
+def select_random_character(user_id):
+    """Seleziona un personaggio casuale dalla lista e lo salva come personaggio in gioco dell'utente."""
+    if not _CHARACTERS:
         return None
     
-    char = random.choice(characters)
-    context.user_data[CURRENT_CHAR_KEY] = char
+    char = _CHARACTERS[_randrange(len(_CHARACTERS))]
+    _CURRENT_CHARACTERS[user_id] = char
     return char
 
-def format_category_name(category_key):
-    """Mappa le chiavi interne (COMUNE, GENIO) in testo formattato in italiano per l'utente."""
-    mapping = {
-        "GENIO": "Genio",
-        "MASSONE": "Massone",
-        "ENTRAMBI": "Genio e Massone",
-        "COMUNE": "Persona Comune",
-        "PERSONA COMUNE": "Persona Comune" 
-    }
-    return mapping.get(category_key.strip().upper(), category_key)
-
-def get_bio_explanation_cleaned(current_char):
-    """Estrae la spiegazione biografica e rimuove la frase iniziale (es. 'È un Genio. Precisamente:')."""
-    full_bio_text = current_char.get('Bio', 'Informazioni non disponibili.').strip()
-    correct_category_key = str(current_char.get('Categoria', '')).strip().upper()
-    correct_category_name = format_category_name(correct_category_key)
-    
-    # Pattern 1: GENIO o MASSONE (puri)
-    intro_pattern_1 = f"È un **{correct_category_name}**. Precisamente:"
-    
-    # Pattern 2: ENTRAMBI (CORREZIONE DEL BUG: si focalizza sulla frase di Genio e Massone)
-    intro_pattern_2 = "È un **Genio e Massone**. Infatti," 
-    
-    # Pattern 3: COMUNE (lasciamo la bio completa, è già la spiegazione)
-    if correct_category_key == "COMUNE" or "Persona Comune" in full_bio_text:
-        return full_bio_text 
+# Nomi in italiano delle categorie, indicizzati per chiave interna (già normalizzata, come nelle callback_data)
+_CATEGORY_NAMES = {
+    "GENIO": "Genio",
+    "MASSONE": "Massone",
+    "ENTRAMBI": "Genio e Massone",
+    "COMUNE": "Persona Comune"
+}
 
-    # Rimuovi Pattern 1 (copre Genio e Massone puri)
-    if full_bio_text.startswith(intro_pattern_1):
-        return full_bio_text.replace(intro_pattern_1, "").strip()
+# Frase iniziale delle bio da togliere dalla spiegazione: "È un **Genio**. Precisamente:",
+# "È un **Massone**. Precisamente:" oppure "È un **Genio e Massone**. Infatti,".
+# Le bio delle persone comuni non la hanno: sono già la spiegazione e restano intatte.
+_BIO_INTRO_RE = re.compile(r"^È un \*\*(?:Genio|Massone|Genio e Massone)\*\*\. (?:Precisamente:|Infatti,)")
 
-    # Rimuovi Pattern 2 (copre Entrambi)
-    if correct_category_key == "ENTRAMBI" and full_bio_text.startswith(intro_pattern_2):
-        return full_bio_text.replace(intro_pattern_2, "").strip()
-        
-    return full_bio_text
+# Grassetto in stile Markdown (**testo**) usato nelle bio del CSV
+_BOLD_RE = re.compile(r"\*\*(.+?)\*\*")
+
+def format_category_name(category_key):
+    """Mappa le chiavi interne (COMUNE, GENIO) in testo formattato in italiano per l'utente."""
+    return _CATEGORY_NAMES.get(category_key, category_key)
+
+def get_bio_explanation_cleaned(bio):
+    """Estrae la spiegazione biografica e rimuove la frase iniziale (es. 'È un Genio. Precisamente:').
+
+    Viene chiamata una sola volta per personaggio, durante la lettura del CSV.
+    """
+    full_bio_text = (bio or 'Informazioni non disponibili.').strip()
+    return _BIO_INTRO_RE.sub("", full_bio_text, count=1).strip()
+
+def bio_to_html(bio):
+    """Converte una bio del CSV in HTML per Telegram: escape dei caratteri speciali e **grassetto** in <b>."""
+    return _BOLD_RE.sub(r"<b>\1</b>", html.escape(bio, quote=False))
+
+def build_result_headers():
+    """Prepara l'intestazione del messaggio di esito per ogni coppia (risposta, categoria corretta).
+
+    Il messaggio finale è l'intestazione seguita dalla spiegazione del personaggio.
+    """
+    headers = {}
+    for user_guess in _CATEGORIES:
+        for correct_answer in _CATEGORIES:
+            if user_guess == correct_answer:
+                # CASO CORRETTO
+                headers[(user_guess, correct_answer)] = (
+                    "✅ <b>Corretto!</b> Hai indovinato!\n\n"
+                    "Spiegazione:\n"
+                )
+            else:
+                # CASO SBAGLIATO
+                headers[(user_guess, correct_answer)] = (
+                    f"❌ <b>Sbagliato!</b> Hai risposto: <i>{format_category_name(user_guess)}</i>\n\n"
+                    f"La risposta corretta è: <b>{format_category_name(correct_answer)}</b>.\n\n"
+                    f"Spiegazione:\n"
+                )
+    return headers
+
+_RESULT_HEADERS = build_result_headers()
 
 # --- GESTORI TELEGRAM (HANDLERS) ---
 
-def get_quiz_keyboard():
-    """Definisce la tastiera con callback_data pulite (GENIO, COMUNE, etc.)."""
-    keyboard = [
-        [
-            InlineKeyboardButton("Genio 🧠", callback_data="GENIO"),
-            InlineKeyboardButton("Massone 📐", callback_data="MASSONE")
-        ],
-        [
-            InlineKeyboardButton("Entrambi 👑", callback_data="ENTRAMBI"),
-            InlineKeyboardButton("Persona Comune 🚶", callback_data="COMUNE") 
-        ]
+# Le tastiere sono statiche: vengono costruite una sola volta al caricamento del modulo.
+# Tastiera del quiz, con callback_data pulite (GENIO, COMUNE, etc.)
+_QUIZ_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Genio 🧠", callback_data="GENIO"),
+        InlineKeyboardButton("Massone 📐", callback_data="MASSONE")
+    ],
+    [
+        InlineKeyboardButton("Entrambi 👑", callback_data="ENTRAMBI"),
+        InlineKeyboardButton("Persona Comune 🚶", callback_data="COMUNE") 
     ]
-    return InlineKeyboardMarkup(keyboard)
-
-def get_post_guess_keyboard():
-    """Restituisce la tastiera inline per continuare o chiudere il gioco."""
-    keyboard = [
-        [
-            InlineKeyboardButton("Un altro personaggio! 👉", callback_data="PLAY_AGAIN"),
-        ],
-        [
-            InlineKeyboardButton("Mi fermo qui 👋", callback_data="STOP_GAME")
-        ]
+])
+
+# Tastiera per continuare o chiudere il gioco dopo una risposta
+_POST_GUESS_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Un altro personaggio! 👉", callback_data="PLAY_AGAIN"),
+    ],
+    [
+        InlineKeyboardButton("Mi fermo qui 👋", callback_data="STOP_GAME")
     ]
-    return InlineKeyboardMarkup(keyboard)
+])
 
 
 async def start_and_play(update: Update, context):
     """Funzione unificata per /start e per il pulsante 'Gioca Ancora'."""
-    current_char = select_random_character(context)
+    current_char = select_random_character(update.effective_user.id)
     
     if current_char:
-        message = (
-            f"Il personaggio scelto a caso è: **{current_char['Nome']}**\n\n"
-            f"Indovina la sua vera identità:"
-        )
+        message = current_char.start_message
         
         if update.callback_query:
             await update.callback_query.edit_message_text(
                 message, 
-                reply_markup=get_quiz_keyboard(),
-                parse_mode=ParseMode.MARKDOWN
+                reply_markup=_QUIZ_KEYBOARD,
+                parse_mode=ParseMode.HTML
             )
         else:
             await update.message.reply_text(
-                f"🎉 **Benvenuto nel quiz randomico!**\n\n{message}", 
-                reply_markup=get_quiz_keyboard(),
-                parse_mode=ParseMode.MARKDOWN
+                f"🎉 <b>Benvenuto nel quiz randomico!</b>\n\n{message}", 
+                reply_markup=_QUIZ_KEYBOARD,
+                parse_mode=ParseMode.HTML
             )
     else:
         responder = update.callback_query.message if update.callback_query else update.message
@@ -144,124 +232,171 @@ async def start_and_play(update: Update, context):
 
 
 async def button_callback_handler(update: Update, context):
-    """Gestisce la pressione di tutti i pulsanti Inline e verifica la risposta."""
-    query = update.callback_query
-    await query.answer()
+    """Gestisce la pressione di tutti i pulsanti Inline e verifica la risposta.
 
+    La conferma del pulsante (query.answer) e la modifica del messaggio sono chiamate
+    indipendenti all'API di Telegram: vengono inviate insieme con asyncio.gather.
+    """
+    query = update.callback_query
     action = query.data
     
     if action == "PLAY_AGAIN":
-        await start_and_play(update, context)
+        await asyncio.gather(query.answer(), start_and_play(update, context))
         return
     
     if action == "STOP_GAME":
-        await query.edit_message_text("Grazie per aver giocato! Ciao! 👋")
-        context.user_data.pop(CURRENT_CHAR_KEY, None)
+        # Lo stato dell'utente si libera prima delle chiamate a Telegram, che possono fallire
+        _CURRENT_CHARACTERS.pop(query.from_user.id, None)
+        await asyncio.gather(query.answer(), query.edit_message_text("Grazie per aver giocato! Ciao! 👋"))
         return
         
     # --- Gestione della Risposta al Quiz ---
     
-    current_char = context.user_data.get(CURRENT_CHAR_KEY)
+    current_char = _CURRENT_CHARACTERS.get(query.from_user.id)
     
     if not current_char:
-        await query.edit_message_text("Sessione scaduta. Riprova con /start.")
+        await asyncio.gather(query.answer(), query.edit_message_text("Sessione scaduta. Riprova con /start."))
         return
         
-    # 1. Normalizzazione per il confronto
-    user_guess = action.strip().upper() 
-    correct_answer = str(current_char['Categoria']).strip().upper()
-    
-    # Patch per allineare il vecchio "PERSONA COMUNE" a "COMUNE" se necessario
-    if correct_answer == "PERSONA COMUNE":
-        correct_answer = "COMUNE" 
+    # Intestazione dell'esito, precalcolata per ogni coppia (risposta, categoria corretta)
+    result_header = _RESULT_HEADERS.get((action, current_char.categoria))
     
-    esito_corretto = (user_guess == correct_answer)
-
-    # 2. Preparazione dei messaggi
-    user_guess_it = format_category_name(user_guess)
-    correct_answer_it = format_category_name(correct_answer)
+    if result_header is None:
+        # callback_data non generata dalla tastiera del quiz: la ignoriamo
+        await query.answer()
+        return
     
-    # CHIAMATA AGGIORNATA: ottiene solo il corpo della spiegazione (senza la frase introduttiva)
-    bio_explanation_body = get_bio_explanation_cleaned(current_char)
-
-    # 3. Costruzione del messaggio di ESITO
-    if esito_corretto:
-        # CASO CORRETTO
-        result_message = (
-            f"✅ **Corretto!** Hai indovinato!\n\n"
-            f"Spiegazione:\n"
-            f"{bio_explanation_body}"
-        )
-    else:
-        # CASO SBAGLIATO
-        result_message = (
-            f"❌ **Sbagliato!** Hai risposto: _{user_guess_it}_\n\n"
-            f"La risposta corretta è: **{correct_answer_it}**.\n\n"
-            f"Spiegazione:\n"
-            f"{bio_explanation_body}"
-        )
+    # Spiegazione (senza la frase introduttiva), già calcolata alla lettura del CSV
+    result_message = result_header + current_char.bio_html
         
+    # Il personaggio è stato giocato: si libera prima delle chiamate a Telegram, che possono fallire
+    # (es. "query is too old" per un pulsante rimasto in coda durante un riavvio)
+    _CURRENT_CHARACTERS.pop(query.from_user.id, None)
+    
     # Risposta finale e opzione per continuare
-    await query.edit_message_text(
-        result_message,
-        reply_markup=get_post_guess_keyboard(),
-        parse_mode=ParseMode.MARKDOWN
+    await asyncio.gather(
+        query.answer(),
+        query.edit_message_text(
+            result_message,
+            reply_markup=_POST_GUESS_KEYBOARD,
+            parse_mode=ParseMode.HTML
+        )
     )
-    context.user_data.pop(CURRENT_CHAR_KEY, None)
 
 
 # --- CONFIGURAZIONE FASTAPI E PTB ---
 
-app = FastAPI()
-application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+application = (
+    Application.builder()
+    .token(TELEGRAM_BOT_TOKEN)
+    # HTTP/2 multiplexa le chiamate verso api.telegram.org su una sola connessione TLS
+    .http_version("2")
+    .connection_pool_size(256)
+    # Con molti giocatori insieme meglio attendere una connessione libera che fallire dopo 1s
+    .pool_timeout(20)
+    .connect_timeout(10)
+    .read_timeout(20)
+    .build()
+)
 bot = application.bot
 
 application.add_handler(CommandHandler("start", start_and_play))
 application.add_handler(CallbackQueryHandler(button_callback_handler))
 
-@app.on_event("startup")
-async def startup_event():
-    logger.info("Avvio del server...")
-    
-    await application.initialize()
-    await application.start()
-    
+async def setup_webhook():
+    """Registra il webhook su Telegram, solo se la configurazione attuale è diversa."""
     full_webhook_url = f"{WEBHOOK_URL_BASE}{WEBHOOK_PATH}"
-    logger.info(f"Tentativo di impostare il Webhook su: {full_webhook_url}")
     
-    await bot.delete_webhook()
+    # Evita di reimpostare il webhook a ogni riavvio se Telegram ha già la configurazione attuale.
+    # Il secret token non compare in getWebhookInfo, ma una sua impronta HMAC fa parte dell'URL (vedi WEBHOOK_PATH).
+    info = await bot.get_webhook_info()
+    if (
+        info.url == full_webhook_url
+        and info.max_connections == WEBHOOK_MAX_CONNECTIONS
+        and set(info.allowed_updates or ()) == set(WEBHOOK_ALLOWED_UPDATES)
+    ):
+        logger.info("Webhook già impostato su: %s", full_webhook_url)
+        return
+    
+    logger.info("Tentativo di impostare il Webhook su: %s", full_webhook_url)
     
-    success = await bot.set_webhook(url=full_webhook_url)
+    success = await bot.set_webhook(
+        url=full_webhook_url,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=WEBHOOK_ALLOWED_UPDATES,
+        # Gli update in attesa si scartano solo quando cambia l'URL, mai per un semplice riavvio
+        drop_pending_updates=info.url != full_webhook_url,
+        secret_token=TELEGRAM_SECRET_TOKEN
+    )
     
     if success:
         logger.info("Webhook impostato con successo!")
     else:
         logger.error("Impostazione del Webhook fallita.")
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Eseguito alla chiusura del server: spegne l'Application PTB."""
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Avvio e spegnimento del server: carica il CSV, avvia l'Application PTB e il webhook."""
+    global _CHARACTERS
+    logger.info("Avvio del server...")
+    
+    _CHARACTERS = tuple(read_characters())
+    logger.info("Caricati %d personaggi da %s.", len(_CHARACTERS), CSV_FILE)
+    
+    await application.initialize()
+    await application.start()
+    
+    await setup_webhook()
+    
+    yield
+    
     logger.info("Spegnimento dell'Application PTB.")
     await application.stop()
+    await application.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 
 # --- ENDPOINT FASTAPI ---
 
+# Risposte del webhook costruite una sola volta: nessuna serializzazione per richiesta
+# Telegram guarda solo lo status: anche in caso di errore si conferma con un 200 vuoto,
+# altrimenti Telegram continuerebbe a reinviare lo stesso update
+_WEBHOOK_ACK = Response(status_code=200)
+_WEBHOOK_FORBIDDEN = Response(status_code=403)
+
+# Risposta del controllo di salute, serializzata una volta sola
+_HEALTH_RESPONSE = Response(
+    content=b'{"status":"ok","message":"Bot Server is Running"}',
+    media_type="application/json"
+)
+
 @app.get("/")
 def read_root():
-    return {"status": "ok", "message": "Bot Server is Running"}
+    return _HEALTH_RESPONSE
 
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
     """Endpoint principale che riceve gli aggiornamenti da Telegram."""
+    # Scarta le richieste contraffatte prima di leggere il corpo JSON
+    # Confronto a tempo costante; i byte evitano il TypeError di compare_digest su header non ASCII
+    if TELEGRAM_SECRET_TOKEN and not secrets.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(),
+        TELEGRAM_SECRET_TOKEN.encode()
+    ):
+        logger.warning("Richiesta al webhook con secret token non valido: ignorata.")
+        return _WEBHOOK_FORBIDDEN
+
     try:
-        update_json = await request.json()
-        await application.update_queue.put(
+        update_json = orjson.loads(await request.body())
+        # La coda di PTB non ha limite di dimensione: put_nowait accoda senza attendere,
+        # così Telegram riceve subito la conferma e l'update viene gestito in background
+        application.update_queue.put_nowait(
             Update.de_json(data=update_json, bot=bot)
         )
         
-        return {"message": "Update processed"}
+        return _WEBHOOK_ACK
         
     except Exception as e:
-        logger.error(f"Errore nell'elaborazione dell'update: {e}")
-        return {"message": "Internal Server Error, but acknowledged"}
+        logger.error("Errore nell'elaborazione dell'update: %s", e)
+        return _WEBHOOK_ACK